@@ -1,16 +1,20 @@
+import functools
+import json
 import os
 import warnings
-from typing import Callable, Dict, Optional, Union, Tuple, List
+from typing import Callable, Dict, Optional, Tuple
 
-import joblib
 import numpy as np
 import pandas as pd
 import tensorflow as tf
 from sklearn.exceptions import NotFittedError
-from tensorflow.keras.callbacks import Callback, EarlyStopping, LambdaCallback
+from sklearn.model_selection import train_test_split
+from tensorflow.keras import mixed_precision
+from tensorflow.keras.callbacks import EarlyStopping, LambdaCallback, TerminateOnNaN
+from tensorflow.keras.initializers import RandomNormal
 from tensorflow.keras.layers import Dense, Input, Layer
 from tensorflow.keras.losses import BinaryCrossentropy
-from tensorflow.keras.models import Model
+from tensorflow.keras.models import Model, load_model
 from tensorflow.keras.optimizers import Adam
 
 from logger import get_logger
@@ -19,10 +23,9 @@ os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # or any {'0', '1', '2'}
 warnings.filterwarnings("ignore")
 
 
-MODEL_PARAMS_FNAME = "model_params.save"
-MODEL_WTS_FNAME = "model_wts.save"
+MODEL_PARAMS_FNAME = "model_params.json"
+MODEL_FNAME = "model.keras"
 HISTORY_FNAME = "history.json"
-COST_THRESHOLD = float("inf")
 
 
 logger = get_logger(task_name="tf_model_training")
@@ -38,6 +41,45 @@ gpu_avai = (
 )
 logger.info(gpu_avai)
 
+# The network is a small MLP, so its GEMMs are too small to benefit from one
+# thread per core; a few intra-op threads avoid synchronization overhead and
+# oversubscription on large hosts.
+try:
+    tf.config.threading.set_intra_op_parallelism_threads(min(4, os.cpu_count() or 1))
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+except RuntimeError:
+    # thread pools can't be changed once the TF runtime is initialized
+    logger.warning("TensorFlow runtime already initialized; thread pools unchanged.")
+
+
+def cpu_supports_bfloat16() -> bool:
+    """
+    Check whether the host CPU has native bfloat16 instructions.
+
+    Returns:
+        bool: True if the CPU flags list AVX512_BF16 or AMX_BF16, False otherwise
+            (including on hosts where /proc/cpuinfo is not available).
+    """
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as file_:
+            cpu_flags = file_.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in cpu_flags or "amx_bf16" in cpu_flags
+
+
+# bfloat16 compute (with float32 variables) is opt-in: for this small network the
+# extra casts can outweigh the faster GEMMs. It is only applied on CPUs that
+# natively support bfloat16 so that older CPUs do not fall back to emulated math.
+use_mixed_bfloat16 = os.environ.get("USE_MIXED_BFLOAT16", "false").lower() == "true"
+if (
+    use_mixed_bfloat16
+    and not tf.config.list_physical_devices("GPU")
+    and cpu_supports_bfloat16()
+):
+    mixed_precision.set_global_policy("mixed_bfloat16")
+logger.info(f"Mixed precision policy: {mixed_precision.global_policy().name}")
+
 
 def create_logger(log_period: int, log_type: str = "epoch") -> Callable:
     """
@@ -63,65 +105,82 @@ def create_logger(log_period: int, log_type: str = "epoch") -> Callable:
     """
 
     def log_function(log_count: int, logs: Dict) -> None:
-        logs_str = ""
-        for k, v in logs.items():
-            logs_str += f"{k}: {np.round(v, 4)}  "
-        if log_count % log_period == 0:
-            logger.info(f"{log_type.capitalize()}: {log_count}, Metrics: {logs_str}")
+        # only pay for formatting the metrics on the epochs/batches that are logged
+        if log_count % log_period != 0:
+            return
+        logs_str = "  ".join(f"{k}: {v:.4f}" for k, v in logs.items())
+        logger.info(f"{log_type.capitalize()}: {log_count}, Metrics: {logs_str}")
 
     return log_function
 
 
-class InfCostStopCallback(Callback):
-    def on_epoch_end(self, epoch, logs={}):
-        loss_val = logs.get("loss")
-        if loss_val == COST_THRESHOLD or tf.math.is_nan(loss_val):
-            logger.warning(f"Cost is {loss_val}, so stopping training!!")
-            self.model.stop_training = True
-
-
-def get_init_values(shape: Union[Tuple[int, ...], List[int]]) -> np.ndarray:
+def get_tf_dataset(
+    inputs: np.ndarray, targets: np.ndarray, batch_size: int, shuffle: bool = False
+) -> tf.data.Dataset:
     """
-    Initializes values with given shape using random normal distribution.
+    Create a cached, batched and prefetched tf.data pipeline from in-memory arrays.
+
+    Building the pipeline once avoids Keras re-slicing and re-converting the
+    pandas objects on every epoch, and prefetching overlaps batch preparation
+    with training. Shuffling happens in the tf.data runtime on the cached
+    elements before batching, so no per-epoch shuffle of the feature arrays is
+    done by Keras.
 
     Args:
-        shape (Union[Tuple[int, ...], List[int]]): The shape of the values to be
-            initialized. This can be a tuple or list of integers.
+        inputs (np.ndarray): The input features.
+        targets (np.ndarray): The targets.
+        batch_size (int): The batch size.
+        shuffle (bool): Whether to reshuffle the samples on each iteration
+                    (i.e. every epoch). Defaults to False.
 
     Returns:
-        np.ndarray: Initialized values reshaped into the given shape.
-
-    Examples:
-        >>> shape = (2, 3)
-        >>> vals = get_init_values(shape)
-        >>> print(vals.shape)
-        (2, 3)
-
-    Notes:
-        The values are drawn from a standard normal distribution (mean=0, stdev=1).
+        tf.data.Dataset: The dataset yielding (inputs, targets) batches.
     """
-    dim = np.prod(shape)
-    vals = np.random.randn(dim)
-    return vals.reshape(shape)
+    dataset = tf.data.Dataset.from_tensor_slices((inputs, targets)).cache()
+    if shuffle:
+        dataset = dataset.shuffle(
+            buffer_size=inputs.shape[0], seed=0, reshuffle_each_iteration=True
+        )
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
 
 
 class TrainableActivationLayer(Layer):
     """
     Custom layer for trainable activation function.
 
+    The weights of each change point are kept as separate (D,) variables so that
+    the activation is traced as straight-line code over the change points,
+    without softmax or reduction ops over a change-point axis.
+
     Attributes:
         num_cps (int): Number of change points for the activation function.
-        slopes (tf.Variable): Variable for slopes of the activation function.
-        intercepts (tf.Variable): Variable for intercepts of the activation function.
-        locations (tf.Variable): Variable for locations of the change points.
+        locations (List[tf.Variable]): Variables for the locations of the change
+            points, one per change point.
+        location_values (List[tf.Variable]): Variables for the activation values
+            at the change points, one per change point.
         lambda_ (tf.Variable): Variable for the lambda parameter of the activation
             function.
+
+    With a single change point the softmax weight is always 1 and the output
+    does not depend on the locations or lambda, so those variables are not
+    created (`locations` is empty and `lambda_` is None).
     """
 
-    def __init__(self, num_cps: int):
-        super(TrainableActivationLayer, self).__init__()
+    def __init__(self, num_cps: int, **kwargs):
+        super(TrainableActivationLayer, self).__init__(**kwargs)
         self.num_cps = num_cps
 
+    def get_config(self) -> Dict:
+        """
+        Return the layer config so that the layer can be re-created on load.
+
+        Returns:
+            Dict: The layer config.
+        """
+        config = super(TrainableActivationLayer, self).get_config()
+        config.update({"num_cps": self.num_cps})
+        return config
+
     def build(self, input_shape: Tuple[int, ...]):
         """
         Create the layer's variables.
@@ -130,49 +189,89 @@ class TrainableActivationLayer(Layer):
             input_shape (Tuple[int, ...]): Shape of the input.
         """
         D = input_shape[-1]
-        shape = (1, D, self.num_cps)
-        self.locations = tf.Variable(
-            initial_value=get_init_values(shape), dtype=tf.float32
-        )  # shape => (1, D, num_cps)
-        self.location_values = tf.Variable(
-            initial_value=get_init_values(shape), dtype=tf.float32
-        )  # shape => (1, D, num_cps)
-        shape = (1, D, 1)
-        self.lambda_ = tf.Variable(
-            initial_value=get_init_values(shape), dtype=tf.float32
-        )  # shape => (1, D, 1)
+        # values are drawn from a standard normal distribution (mean=0, stdev=1).
+        # Each weight gets its own initializer instance; a shared unseeded
+        # instance would return identical values for every weight.
+        shape = (D,)
+        self.location_values = [
+            self.add_weight(
+                name=f"location_value_{i}",
+                shape=shape,
+                initializer=RandomNormal(mean=0.0, stddev=1.0),
+                trainable=True,
+            )
+            for i in range(self.num_cps)
+        ]  # num_cps x shape => (D,)
+        if self.num_cps == 1:
+            # locations and lambda would be disconnected from the output
+            self.locations = []
+            self.lambda_ = None
+            return
+        self.locations = [
+            self.add_weight(
+                name=f"location_{i}",
+                shape=shape,
+                initializer=RandomNormal(mean=0.0, stddev=1.0),
+                trainable=True,
+            )
+            for i in range(self.num_cps)
+        ]  # num_cps x shape => (D,)
+        self.lambda_ = self.add_weight(
+            name="lambda_",
+            shape=shape,
+            initializer=RandomNormal(mean=0.0, stddev=1.0),
+            trainable=True,
+        )  # shape => (D,)
 
     def call(self, inputs: tf.Tensor) -> tf.Tensor:
         """
         Compute the output of the layer.
 
+        The loops over the change points run in Python at trace time, so the
+        traced graph is fully unrolled for the layer's `num_cps`.
+
         Args:
             inputs (tf.Tensor): Input tensor.
-        
+
         Returns:
             tf.Tensor: Output tensor after applying the trainable activation function.
         """
-        inputs = tf.expand_dims(
-            inputs, axis=2, name="expand_dims"
-        )  # shape goes from (NxD) => (N, D, 1)
-        sq_diff = tf.math.square(
-            inputs - self.locations, name="sq_diff"
-        )  # shape = (N, D, num_cps)
-        exp = tf.math.exp(
-            -self.lambda_ * sq_diff, name="exp"
-        )  # shape = (N, D, num_cps)
-        probs = tf.nn.softmax(exp, name="softmax")  # shape = (N, D, num_cps)
-
-        loc_vals_x_probs = self.location_values * probs # shape = (N, D, num_cps)
-
-        output_ = tf.math.reduce_sum(
-            loc_vals_x_probs, axis=-1, name="output"
+        # variables are kept in float32; compute in the layer's compute dtype
+        location_values = [
+            tf.cast(v, self.compute_dtype) for v in self.location_values
+        ]  # num_cps x (D,)
+        if self.num_cps == 1:
+            # the softmax over a single change point is always 1
+            return tf.math.tanh(tf.broadcast_to(location_values[0], tf.shape(inputs)))
+
+        lambda_ = tf.cast(self.lambda_, self.compute_dtype)
+        logits = [
+            tf.math.exp(
+                -lambda_ * tf.math.square(inputs - tf.cast(loc, self.compute_dtype))
+            )
+            for loc in self.locations
+        ]  # num_cps x (N, D)
+
+        if self.num_cps == 2:
+            # softmax of two logits: p0 = sigmoid(l0 - l1), p1 = 1 - p0
+            p0 = tf.math.sigmoid(logits[0] - logits[1])
+            output_ = location_values[1] + p0 * (
+                location_values[0] - location_values[1]
+            )  # shape = (N, D)
+            return tf.math.tanh(output_)
+
+        # softmax-weighted sum of the location values, computed as
+        # sum(loc_vals * e) / sum(e) with max-subtracted logits
+        max_logit = functools.reduce(tf.math.maximum, logits)
+        weights = [tf.math.exp(logit - max_logit) for logit in logits]
+        numerator = functools.reduce(
+            tf.math.add, [v * w for v, w in zip(location_values, weights)]
         )  # shape = (N, D)
-        output_ = tf.math.tanh(output_)
+        denominator = functools.reduce(tf.math.add, weights)  # shape = (N, D)
+        output_ = tf.math.tanh(numerator / denominator)
         return output_
 
 
-
 class Classifier:
     """
     A wrapper class for the ANN with Training Activation Function Binary classifier
@@ -209,6 +308,17 @@ class Classifier:
         # input layer
         self.model = None
 
+    @property
+    def model(self) -> Optional[Model]:
+        """The underlying Keras network, or None if not fitted yet."""
+        return self._model
+
+    @model.setter
+    def model(self, model: Optional[Model]) -> None:
+        # rebuild the inference function so it always runs the current network
+        self._model = model
+        self._predict_fn = None if model is None else self._build_predict_fn(model)
+
     def build_model(self):
         input_ = Input(self.D)
         x = input_
@@ -216,16 +326,47 @@ class Classifier:
         x = TrainableActivationLayer(num_cps=self.num_cps)(x)
         x = Dense(self.D*2)(x)
         x = TrainableActivationLayer(num_cps=self.num_cps)(x)
-        x = Dense(1, activation="sigmoid")(x)
+        # keep the output layer in float32 for a numerically stable loss
+        x = Dense(1, activation="sigmoid", dtype="float32")(x)
         output_ = x
         model = Model(input_, output_, name="binary_classifier_ann_train_act_fn")
         # model.summary()
+        self._compile_model(model)
+        return model
+
+    def _compile_model(self, model: Model) -> None:
+        """Compile the given network with the classifier's loss and optimizer.
+
+        Args:
+            model (Model): The network to compile.
+        """
         model.compile(
             loss=BinaryCrossentropy(),
             optimizer=Adam(learning_rate=self.lr),
             metrics=["accuracy"],
+            # run several train steps per tf.function call; per-step compute is
+            # tiny for this network, so Keras dispatch overhead dominates
+            steps_per_execution=16,
+        )
+
+    @staticmethod
+    def _build_predict_fn(model: Model) -> Callable:
+        """Trace the given model's forward pass once into a reusable tf.function.
+
+        The relaxed batch dimension lets inference calls of any size reuse the
+        same graph instead of going through `model.predict` on every call.
+
+        Args:
+            model (Model): The network to run.
+
+        Returns:
+            Callable: Function mapping a float32 (N, D) tensor to class 1
+                probabilities.
+        """
+        return tf.function(
+            lambda inputs: model(inputs, training=False),
+            input_signature=[tf.TensorSpec([None, model.input_shape[-1]], tf.float32)],
         )
-        return model
 
     def fit(
         self,
@@ -240,40 +381,49 @@ class Classifier:
             train_inputs (pandas.DataFrame): The features of the training data.
             train_targets (pandas.Series): The labels of the training data.
         """
+        # cast once to contiguous float32 arrays instead of letting keras convert
+        # (and downcast) the pandas objects on every batch of every epoch
+        train_x = np.ascontiguousarray(train_inputs.to_numpy(dtype=np.float32))
+        train_y = np.ascontiguousarray(train_targets.to_numpy(dtype=np.float32))
+
         # get data dimensionality and build network
-        self.D = train_inputs.shape[1]
+        self.D = train_x.shape[1]
         self.model = self.build_model()
 
         # set seed for reproducibility
         tf.random.set_seed(0)
 
         # use 15% validation split if at least 300 samples in training data
-        if train_inputs.shape[0] < 300:
+        if train_x.shape[0] < 300:
             loss_to_monitor = "loss"
-            validation_split = None
+            validation_data = None
         else:
             loss_to_monitor = "val_loss"
-            validation_split = 0.15
+            train_x, valid_x, train_y, valid_y = train_test_split(
+                train_x, train_y, test_size=0.15, random_state=0
+            )
+            validation_data = get_tf_dataset(valid_x, valid_y, batch_size)
+        train_data = get_tf_dataset(train_x, train_y, batch_size, shuffle=True)
 
         early_stop_callback = EarlyStopping(
             monitor=loss_to_monitor, min_delta=1e-3, patience=20
         )
-        infcost_stop_callback = InfCostStopCallback()
+        # stops training as soon as the loss becomes NaN or inf
+        terminate_on_nan_callback = TerminateOnNaN()
         logger_callback = LambdaCallback(
             on_epoch_end=create_logger(self._log_period, "epoch")
         )
 
         self.model.fit(
-            x=train_inputs,
-            y=train_targets,
-            batch_size=batch_size,
-            validation_split=validation_split,
+            train_data,
+            validation_data=validation_data,
             epochs=epochs,
-            shuffle=True,
+            # shuffling is done by the tf.data pipeline
+            shuffle=False,
             verbose=False,
             callbacks=[
                 early_stop_callback,
-                infcost_stop_callback,
+                terminate_on_nan_callback,
                 logger_callback,
             ],
         )
@@ -286,7 +436,10 @@ class Classifier:
         Returns:
             numpy.ndarray: The predicted class probabilities.
         """
-        return self.model.predict(inputs, verbose=False)
+        if self._predict_fn is None:
+            raise NotFittedError("Model is not fitted yet.")
+        inputs = tf.convert_to_tensor(np.asarray(inputs, dtype=np.float32))
+        return self._predict_fn(inputs).numpy()
 
     def predict(self, inputs: pd.DataFrame) -> np.ndarray:
         """Predict class labels for the given data.
@@ -296,9 +449,12 @@ class Classifier:
         Returns:
             numpy.ndarray: The predicted class labels.
         """
-        class1_probs = self._predict(inputs).reshape(-1, 1)
-        predicted_labels = (class1_probs >= 0.5).astype(int)
-        return np.squeeze(predicted_labels)
+        class1_probs = self._predict(inputs).ravel()
+        # threshold straight into a compact int8 buffer, skipping the
+        # intermediate bool array and its astype copy
+        predicted_labels = np.empty(class1_probs.size, dtype=np.int8)
+        np.greater_equal(class1_probs, 0.5, out=predicted_labels)
+        return predicted_labels
 
     def predict_proba(self, inputs: pd.DataFrame) -> np.ndarray:
         """Predict class probabilities for the given data.
@@ -308,9 +464,11 @@ class Classifier:
         Returns:
             numpy.ndarray: The predicted class probabilities.
         """
-        class1_probs = self._predict(inputs).reshape(-1, 1)
-        class0_probs = 1.0 - class1_probs
-        probs = np.hstack((class0_probs, class1_probs))
+        class1_probs = self._predict(inputs).ravel()
+        # fill a single (N, 2) buffer instead of allocating and stacking columns
+        probs = np.empty((class1_probs.size, 2), dtype=class1_probs.dtype)
+        np.subtract(1.0, class1_probs, out=probs[:, 0])
+        probs[:, 1] = class1_probs
         return probs
 
     def summary(self):
@@ -340,13 +498,15 @@ class Classifier:
         """
         if self.model is None:
             raise NotFittedError("Model is not fitted yet.")
+        # D is recovered from the saved network's input shape
+        # tuned hyperparameters can be numpy scalars, which json can't encode
         model_params = {
-            "D": self.D,
-            "lr": self.lr,
-            "num_cps": self.num_cps,
+            "lr": float(self.lr),
+            "num_cps": int(self.num_cps),
         }
-        joblib.dump(model_params, os.path.join(model_dir_path, MODEL_PARAMS_FNAME))
-        self.model.save_weights(os.path.join(model_dir_path, MODEL_WTS_FNAME))
+        with open(os.path.join(model_dir_path, MODEL_PARAMS_FNAME), "w") as file_:
+            json.dump(model_params, file_)
+        self.model.save(os.path.join(model_dir_path, MODEL_FNAME))
 
     @classmethod
     def load(cls, model_dir_path: str) -> "Classifier":
@@ -359,12 +519,18 @@ class Classifier:
         """
         if not os.path.exists(model_dir_path):
             raise FileNotFoundError(f"Model dir {model_dir_path} does not exist.")
-        model_params = joblib.load(os.path.join(model_dir_path, MODEL_PARAMS_FNAME))
+        with open(os.path.join(model_dir_path, MODEL_PARAMS_FNAME), "r") as file_:
+            model_params = json.load(file_)
         classifier_model = cls(**model_params)
-        classifier_model.model = classifier_model.build_model()
-        classifier_model.model.load_weights(
-            os.path.join(model_dir_path, MODEL_WTS_FNAME)
-        ).expect_partial()
+        # the optimizer state is not needed for inference, so the network is
+        # loaded uncompiled and compiled afresh for evaluation
+        classifier_model.model = load_model(
+            os.path.join(model_dir_path, MODEL_FNAME),
+            custom_objects={"TrainableActivationLayer": TrainableActivationLayer},
+            compile=False,
+        )
+        classifier_model._compile_model(classifier_model.model)
+        classifier_model.D = classifier_model.model.input_shape[-1]
         return classifier_model
 
     def __str__(self):
@@ -463,7 +629,7 @@ def save_training_history(history, dir_path):
     """
     Save tensorflow model training history to a JSON file
     """
-    hist_df = pd.DataFrame(history.history)
+    metrics = {k: [float(v) for v in vals] for k, vals in history.history.items()}
     hist_json_file = os.path.join(dir_path, HISTORY_FNAME)
     with open(hist_json_file, mode="w") as file_:
-        hist_df.to_json(file_)
+        json.dump(metrics, file_)
@@ -3,12 +3,15 @@ import os
 import numpy as np
 import pandas as pd
 import pytest
+import tensorflow as tf
 from sklearn.datasets import make_classification
 from sklearn.exceptions import NotFittedError
 from sklearn.linear_model import LogisticRegression
+from tensorflow.keras import mixed_precision
 
 from src.prediction.predictor_model import (
     Classifier,
+    TrainableActivationLayer,
     evaluate_predictor_model,
     load_predictor_model,
     predict_with_model,
@@ -40,6 +43,75 @@ def synthetic_data():
     return train_X, train_y, test_X, test_y
 
 
+@pytest.mark.parametrize("num_cps", [1, 2, 3])
+def test_trainable_activation_layer_matches_softmax_formula(num_cps):
+    """
+    Test that the unrolled activation layer computes
+    tanh(sum(v * softmax(exp(-lambda * (x - loc)^2)))) for each supported num_cps.
+    """
+    N, D = 7, 4
+    rng = np.random.default_rng(0)
+    inputs = rng.standard_normal((N, D)).astype(np.float32)
+    locations = rng.standard_normal((D, num_cps)).astype(np.float32)
+    location_values = rng.standard_normal((D, num_cps)).astype(np.float32)
+    lambda_ = rng.uniform(0.1, 2.0, size=D).astype(np.float32)
+
+    layer = TrainableActivationLayer(num_cps=num_cps)
+    layer.build((None, D))
+    for i in range(num_cps):
+        layer.location_values[i].assign(location_values[:, i])
+    if num_cps > 1:
+        for i in range(num_cps):
+            layer.locations[i].assign(locations[:, i])
+        layer.lambda_.assign(lambda_)
+    output = layer(inputs).numpy()
+
+    logits = np.exp(-lambda_[:, None] * (inputs[:, :, None] - locations) ** 2)
+    softmax = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    softmax /= softmax.sum(axis=-1, keepdims=True)
+    expected = np.tanh((location_values * softmax).sum(axis=-1))
+
+    assert output.shape == (N, D)
+    assert np.allclose(output, expected, atol=1e-5)
+
+
+@pytest.fixture
+def mixed_bfloat16_policy():
+    """Set the mixed_bfloat16 global policy and restore the previous one after"""
+    previous_policy = mixed_precision.global_policy()
+    mixed_precision.set_global_policy("mixed_bfloat16")
+    yield
+    mixed_precision.set_global_policy(previous_policy)
+
+
+def test_mixed_bfloat16_policy(mixed_bfloat16_policy, hyperparameters, synthetic_data):
+    """
+    Test that under the mixed_bfloat16 policy the activation layers compute in
+    bfloat16 with float32 variables, while the sigmoid output and the predicted
+    probabilities stay float32.
+    """
+    train_X, train_y, test_X, _ = synthetic_data
+    classifier = Classifier(**hyperparameters)
+    classifier.fit(train_X, train_y)
+
+    activation_layers = [
+        layer
+        for layer in classifier.model.layers
+        if isinstance(layer, TrainableActivationLayer)
+    ]
+    assert len(activation_layers) == 2
+    for layer in activation_layers:
+        assert layer.compute_dtype == "bfloat16"
+        assert layer.output.dtype == tf.bfloat16
+        assert all(weight.dtype == tf.float32 for weight in layer.weights)
+
+    assert classifier.model.layers[-1].compute_dtype == "float32"
+    assert classifier.model.output.dtype == tf.float32
+    proba_predictions = classifier.predict_proba(test_X)
+    assert proba_predictions.dtype == np.float32
+    assert np.all((proba_predictions >= 0) & (proba_predictions <= 1))
+
+
 def test_build_model(default_hyperparameters):
     """
     Test if the classifier is created with the specified hyperparameters.
@@ -87,6 +159,47 @@ def test_fit_predict_evaluate(classifier, synthetic_data):
     assert 0 <= accuracy <= 1
 
 
+def test_fit_with_validation_split(classifier):
+    """
+    Test that with at least 300 training samples the fit holds out a validation
+    set, monitors `val_loss` and finishes training.
+    """
+    X, y = make_classification(n_samples=400, n_features=5, random_state=42)
+    X = pd.DataFrame(X, columns=[f"feature_{i+1}" for i in range(X.shape[1])])
+    y = pd.Series(y, name="target")
+    classifier.fit(X, y)
+
+    history = classifier.model.history.history
+    assert "val_loss" in history
+    assert len(history["val_loss"]) == len(history["loss"]) > 0
+    assert np.all(np.isfinite(history["val_loss"]))
+    assert classifier.predict(X).shape == y.shape
+
+
+def test_untrained_predict_fails(classifier, synthetic_data):
+    """
+    Test that predict and predict_proba raise NotFittedError on an unfitted model.
+    """
+    _, _, test_X, _ = synthetic_data
+    with pytest.raises(NotFittedError):
+        classifier.predict(test_X)
+    with pytest.raises(NotFittedError):
+        classifier.predict_proba(test_X)
+
+
+def test_predict_uses_reassigned_model(classifier, synthetic_data, hyperparameters):
+    """
+    Test that predictions use the current network after `model` is reassigned.
+    """
+    train_X, train_y, test_X, _ = synthetic_data
+    classifier.fit(train_X, train_y)
+    other = Classifier(**{**hyperparameters, "num_cps": 3})
+    other.fit(train_X, train_y)
+
+    classifier.model = other.model
+    assert np.array_equal(classifier.predict_proba(test_X), other.predict_proba(test_X))
+
+
 def test_save_load(tmpdir, classifier, synthetic_data, hyperparameters):
     """
     Test if the save and load methods work correctly and if the loaded model has the
@@ -121,6 +234,45 @@ def test_save_load(tmpdir, classifier, synthetic_data, hyperparameters):
     assert accuracy == classifier.evaluate(test_X, test_y)
 
 
+@pytest.mark.parametrize("num_cps", [1, 3])
+def test_save_load_num_cps(tmpdir, synthetic_data, hyperparameters, num_cps):
+    """
+    Test that models with a single and with three change points can be fitted,
+    saved and loaded, and that the loaded model predicts the same probabilities.
+    """
+    train_X, train_y, test_X, _ = synthetic_data
+    classifier = Classifier(**{**hyperparameters, "num_cps": num_cps})
+    classifier.fit(train_X, train_y)
+
+    model_dir_path = tmpdir.mkdir("model")
+    classifier.save(model_dir_path)
+    loaded_clf = Classifier.load(model_dir_path)
+
+    assert loaded_clf.num_cps == num_cps
+    assert np.array_equal(
+        loaded_clf.predict_proba(test_X), classifier.predict_proba(test_X)
+    )
+
+
+def test_save_load_numpy_hyperparameters(tmpdir, synthetic_data, hyperparameters):
+    """
+    Test that a classifier built with numpy scalar hyperparameters, as returned
+    by hyperparameter tuning, can be saved and loaded.
+    """
+    train_X, train_y, _, _ = synthetic_data
+    classifier = Classifier(
+        **{**hyperparameters, "lr": np.float64(1e-3), "num_cps": np.int64(2)}
+    )
+    classifier.fit(train_X, train_y)
+
+    model_dir_path = tmpdir.mkdir("model")
+    classifier.save(model_dir_path)
+    loaded_clf = Classifier.load(model_dir_path)
+
+    assert loaded_clf.num_cps == 2
+    assert loaded_clf.lr == 1e-3
+
+
 def test_accuracy_compared_to_logistic_regression(classifier, synthetic_data):
     """
     Test if the accuracy of the classifier is close enough to the accuracy of a